@@ -1,66 +1,83 @@
-import os
-from typing import List, Optional
-from pydantic import BaseModel, HttpUrl, field_validator
-import re
-
-class DomainConfig(BaseModel):
-    """Configuration for allowed domains"""
-    allowed_domains: List[str] = [
-        "localhost",
-        "127.0.0.1",
-        "template.online",
-        "www.template.online"
-    ]
-    
-    # Domains that are allowed for video URLs
-    allowed_video_domains: List[str] = [
-        "youtube.com",
-        "youtu.be",
-        "www.youtube.com"
-    ]
-    
-    @field_validator('allowed_domains')
-    def validate_domains(cls, v):
-        """Validate domain format"""
-        for domain in v:
-            if not re.match(r'^[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9]\.[a-zA-Z]{2,}$', domain) and domain not in ['localhost', '127.0.0.1']:
-                raise ValueError(f"Invalid domain format: {domain}")
-        return v
-
-def get_allowed_origins() -> List[str]:
-    """Get list of allowed origins for CORS"""
-    config = DomainConfig()
-    return [f"http://{host}" for host in config.allowed_domains] + [f"https://{host}" for host in config.allowed_domains]
-
-def is_allowed_domain(domain: str) -> bool:
-    """Check if a domain is allowed for API access"""
-    config = DomainConfig()
-    return domain in config.allowed_domains
-
-def is_allowed_video_domain(domain: str) -> bool:
-    """Check if a domain is allowed for video URLs"""
-    config = DomainConfig()
-    return domain in config.allowed_video_domains
-
-def validate_url(url: str) -> bool:
-    """Validate if URL is from allowed domain"""
-    try:
-        parsed_url = HttpUrl(url)
-        domain = parsed_url.host
-        
-        # Check if it's a YouTube URL
-        if any(yt_domain in domain for yt_domain in ['youtube.com', 'youtu.be']):
-            return True
-            
-        # For other URLs, check against allowed domains
-        return is_allowed_domain(domain)
-    except Exception:
-        return False
-
-# Load domains from environment variable if available
-if os.getenv("ALLOWED_DOMAINS"):
-    try:
-        domains = os.getenv("ALLOWED_DOMAINS").split(",")
-        DomainConfig(allowed_domains=domains)
-    except Exception as e:
-        print(f"Error loading domains from environment: {e}") 
\ No newline at end of file
+import os
+from typing import List, Optional, Tuple, FrozenSet
+from urllib.parse import urlsplit
+from pydantic import BaseModel, field_validator
+import re
+
+_DOMAIN_RE = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9]\.[a-zA-Z]{2,}$')
+
+class DomainConfig(BaseModel):
+    """Configuration for allowed domains"""
+    allowed_domains: List[str] = [
+        "localhost",
+        "127.0.0.1",
+        "template.online",
+        "www.template.online"
+    ]
+
+    # Domains that are allowed for video URLs
+    allowed_video_domains: List[str] = [
+        "youtube.com",
+        "youtu.be",
+        "www.youtube.com"
+    ]
+
+    @field_validator('allowed_domains')
+    def validate_domains(cls, v):
+        """Validate domain format"""
+        for domain in v:
+            if not _DOMAIN_RE.match(domain) and domain not in ['localhost', '127.0.0.1']:
+                raise ValueError(f"Invalid domain format: {domain}")
+        return v
+
+def _build_config() -> DomainConfig:
+    """Build the domain config once, merging env-var overrides"""
+    env_domains = os.getenv("ALLOWED_DOMAINS")
+    if env_domains:
+        try:
+            return DomainConfig(allowed_domains=env_domains.split(","))
+        except Exception as e:
+            print(f"Error loading domains from environment: {e}")
+    return DomainConfig()
+
+# Validated once at import time; request-path helpers only do set lookups
+_config = _build_config()
+_ALLOWED_DOMAINS: FrozenSet[str] = frozenset(_config.allowed_domains)
+_ALLOWED_VIDEO_DOMAINS: FrozenSet[str] = frozenset(_config.allowed_video_domains)
+_ALLOWED_ORIGINS: Tuple[str, ...] = tuple(
+    f"{scheme}://{host}"
+    for scheme in ("http", "https")
+    for host in _config.allowed_domains
+)
+
+def get_allowed_origins() -> Tuple[str, ...]:
+    """Get allowed origins for CORS, precomputed at import"""
+    return _ALLOWED_ORIGINS
+
+def get_allowed_domains() -> FrozenSet[str]:
+    """Get the set of domains allowed for API access"""
+    return _ALLOWED_DOMAINS
+
+def is_allowed_domain(domain: str) -> bool:
+    """Check if a domain is allowed for API access"""
+    return domain in _ALLOWED_DOMAINS
+
+def is_allowed_video_domain(domain: str) -> bool:
+    """Check if a domain is allowed for video URLs"""
+    return domain in _ALLOWED_VIDEO_DOMAINS
+
+def validate_url(url: str) -> bool:
+    """Validate if URL is from allowed domain"""
+    try:
+        host = urlsplit(url).hostname
+        if not host:
+            return False
+
+        # Check if it's a YouTube URL
+        if host == 'youtu.be' or host == 'youtube.com' or host.endswith('.youtube.com'):
+            return True
+
+        # For other URLs, check against allowed domains
+        return is_allowed_domain(host)
+    except Exception:
+        return False
@@ -52,7 +52,7 @@ source venv/bin/activate
 # Install Python packages
 print_step "Installing Python packages..."
 pip install --upgrade pip
-pip install fastapi uvicorn yt-dlp google-api-python-client pydantic python-multipart requests aiofiles python-dotenv
+pip install fastapi uvicorn uvloop httptools yt-dlp google-api-python-client pydantic python-multipart requests orjson aiofiles python-dotenv
 
 # Create necessary directories
 print_step "Creating application directories..."
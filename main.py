@@ -2,24 +2,28 @@ import os
 import uuid
 import re
 import asyncio
+import concurrent.futures
+import heapq
 import logging
 import shutil
+import threading
 import time
 import random
-import json
+import orjson
+from collections import OrderedDict
 from pathlib import Path
 from datetime import datetime
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from pydantic import BaseModel, HttpUrl, field_validator
+from pydantic import BaseModel, field_validator
 import yt_dlp
 import requests
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from allowed_domains import get_allowed_origins, validate_url, is_allowed_domain
+from allowed_domains import get_allowed_origins, get_allowed_domains, validate_url
 
 # Configure logging
 logging.basicConfig(
@@ -35,17 +39,55 @@ CACHE_DIR = Path("cache")
 CACHE_DIR.mkdir(exist_ok=True)
 FILE_EXPIRY_MINUTES = 10
 MAX_CONCURRENT_CONVERSIONS = 10
-YOUTUBE_REGEX = r"^(https?://)?(www\.)?(youtube\.com|youtu\.?be)/.+$"
+VIDEO_INFO_CACHE_TTL = 3600  # 1 hour cache
+VIDEO_INFO_CACHE_MAX_SIZE = 10000
+MAX_JOBS = 10000
+TRANSIENT_JOB_TTL = 300  # seconds before queued/failed jobs are swept
+_OUTPUT_EXT_PRIORITY = ('.mp3', '.m4a', '.webm', '.part')
+_SANITIZE_RE = re.compile(r'[\\/*?:"<>|]')
+
+def is_youtube_url(url: str) -> bool:
+    """Fast YouTube URL check; plain prefix tests beat the old backtracking regex"""
+    if url.startswith('https://'):
+        url = url[8:]
+    elif url.startswith('http://'):
+        url = url[7:]
+    if url.startswith('www.'):
+        url = url[4:]
+    for host in ('youtube.com/', 'youtu.be/'):
+        if url.startswith(host):
+            return len(url) > len(host)
+    return False
 
 # YouTube API Configuration
 YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY", "YOUR_API_KEY_HERE")
-youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY)
+_youtube_tls = threading.local()
+
+def _youtube_client():
+    """Per-thread Data API client: httplib2 is not thread-safe, and
+    static_discovery skips the discovery-document fetch at startup"""
+    client = getattr(_youtube_tls, 'client', None)
+    if client is None:
+        client = build(
+            'youtube', 'v3',
+            developerKey=YOUTUBE_API_KEY,
+            cache_discovery=False,
+            static_discovery=True
+        )
+        _youtube_tls.client = client
+    return client
 
 # In-memory storage
-jobs = {}
+jobs = OrderedDict()  # token -> job dict, oldest first
 conversion_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CONVERSIONS)
+conversion_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_CONVERSIONS, thread_name_prefix="ydl"
+)
 current_conversions = set()
-video_info_cache = {}
+url_to_token = {}  # url -> token of the in-flight conversion
+expiry_heap = []  # (expires_at, token) min-heap driving cleanup
+video_info_cache = OrderedDict()  # video_id -> (expiry_ts, info)
+_background_tasks = set()  # strong refs so fire-and-forget tasks aren't GC'd
 
 # Check FFmpeg installation
 def check_ffmpeg():
@@ -57,6 +99,31 @@ def check_ffmpeg():
 
 FFMPEG_PATH = check_ffmpeg()
 
+def _set_job(token: str, job: dict):
+    """Store a job state, ensuring a TTL and bounding total job count"""
+    if 'expires_at' not in job:
+        job['expires_at'] = time.time() + TRANSIENT_JOB_TTL
+    jobs[token] = job
+    jobs.move_to_end(token)
+    heapq.heappush(expiry_heap, (job['expires_at'], token))
+    for _ in range(len(jobs)):
+        if len(jobs) <= MAX_JOBS:
+            break
+        evicted_token, evicted = jobs.popitem(last=False)
+        if evicted.get('status') == 'processing':
+            # Keep in-flight conversions: progress_hook writes jobs[token]
+            jobs[evicted_token] = evicted
+            jobs.move_to_end(evicted_token)
+            continue
+        # The heap sweep skips missing tokens, so delete the file here
+        file_path = evicted.get('file_path')
+        if file_path and os.path.exists(file_path):
+            try:
+                os.remove(file_path)
+                logger.info(f"Deleted file of evicted job: {file_path}")
+            except OSError:
+                pass
+
 # Lifespan manager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -76,7 +143,8 @@ app = FastAPI(
     title="YouTube to MP3 Converter API",
     description="Robust YouTube video to MP3 conversion with automatic cleanup",
     version="2.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Middleware
@@ -87,50 +155,70 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Domain validation middleware
-@app.middleware("http")
-async def validate_domain_middleware(request: Request, call_next):
-    if not is_allowed_domain(request.client.host):
-        return JSONResponse(
-            status_code=403,
-            content={"detail": "Access denied: Domain not allowed"}
-        )
-    return await call_next(request)
+# Domain validation middleware (pure ASGI: avoids building a Request object per call)
+class DomainFilterASGI:
+    _DENIED_BODY = b'{"detail":"Access denied: Domain not allowed"}'
+
+    def __init__(self, app, allowed):
+        self.app = app
+        self.allowed = frozenset(allowed)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            client = scope.get("client")
+            if not client or client[0] not in self.allowed:
+                await send({
+                    "type": "http.response.start",
+                    "status": 403,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(self._DENIED_BODY)).encode()),
+                    ],
+                })
+                await send({
+                    "type": "http.response.body",
+                    "body": self._DENIED_BODY,
+                })
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(DomainFilterASGI, allowed=get_allowed_domains())
 
 # Models
 class ConversionRequest(BaseModel):
-    url: HttpUrl
+    url: str
     quality: str = "high"  # high, medium, low
 
     @field_validator('url')
     def validate_youtube_url(cls, v):
-        if not re.match(YOUTUBE_REGEX, str(v)):
+        if not is_youtube_url(v):
             raise ValueError("Invalid YouTube URL")
         return v
 
 class VideoMetadataRequest(BaseModel):
-    url: HttpUrl
+    url: str
 
     @field_validator('url')
     def validate_youtube_url(cls, v):
-        if not re.match(YOUTUBE_REGEX, str(v)):
+        if not is_youtube_url(v):
             raise ValueError("Invalid YouTube URL")
         return v
 
 # Helper functions
 def sanitize_filename(title: str) -> str:
     """Sanitize filename and ensure it's not too long"""
-    sanitized = re.sub(r'[\\/*?:"<>|]', "", title).strip()
+    sanitized = _SANITIZE_RE.sub("", title).strip()
     return sanitized[:100]  # Max 100 characters
 
+_USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36 Edg/125.0.0.0"
+)
+
 def get_random_user_agent():
     """Return a random modern user agent"""
-    agents = [
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36 Edg/125.0.0.0"
-    ]
-    return random.choice(agents)
+    return _USER_AGENTS[random.randrange(len(_USER_AGENTS))]
 
 def get_video_id(url: str) -> str:
     """Extract video ID from YouTube URL"""
@@ -141,120 +229,272 @@ def get_video_id(url: str) -> str:
             return url.split('v=')[1].split('&')[0]
     return None
 
+API_BATCH_WINDOW = 0.02  # seconds to accumulate IDs before one API call
+API_BATCH_MAX_IDS = 50  # Data API limit per videos().list call
+
+# Pending Data API lookups awaiting the next batch flush
+_api_batch_waiters = {}  # video_id -> list of Futures
+_api_batch_task = None
+
+def _parse_api_video(video: dict, video_id: str) -> dict:
+    return {
+        'title': video['snippet']['title'],
+        'duration': video['contentDetails']['duration'],
+        'thumbnail': video['snippet']['thumbnails']['high']['url'],
+        'uploader': video['snippet']['channelTitle'],
+        'view_count': int(video['statistics']['viewCount']),
+        'id': video_id
+    }
+
+def _api_list_videos(ids: str) -> dict:
+    """Runs in a worker thread with that thread's own API client"""
+    request = _youtube_client().videos().list(
+        part="snippet,contentDetails,statistics",
+        id=ids
+    )
+    return request.execute()
+
+async def _flush_api_batch():
+    """Fire one videos().list call for all IDs gathered in the window"""
+    await asyncio.sleep(API_BATCH_WINDOW)
+    while _api_batch_waiters:
+        batch = {}
+        while _api_batch_waiters and len(batch) < API_BATCH_MAX_IDS:
+            video_id, waiters = _api_batch_waiters.popitem()
+            batch[video_id] = waiters
+        try:
+            response = await asyncio.to_thread(_api_list_videos, ",".join(batch))
+        except Exception as e:
+            # Resolve every waiter: a future left pending would hang its request
+            if isinstance(e, HttpError):
+                logger.error(f"YouTube API error: {str(e)}")
+                error = HTTPException(status_code=500, detail="Error fetching video info from YouTube API")
+            else:
+                logger.error(f"YouTube API request failed: {str(e)}")
+                error = e
+            for waiters in batch.values():
+                for future in waiters:
+                    if not future.done():
+                        future.set_exception(error)
+            continue
+        found = {video['id']: video for video in response.get('items', [])}
+        for video_id, waiters in batch.items():
+            video = found.get(video_id)
+            result = error = None
+            if video is None:
+                error = ValueError("Video not found")
+            else:
+                try:
+                    result = _parse_api_video(video, video_id)
+                except Exception as e:
+                    # e.g. hidden statistics or a missing thumbnail size
+                    error = e
+            for future in waiters:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
 async def get_video_info_from_api(video_id: str) -> dict:
-    """Get video info using YouTube Data API"""
+    """Get video info using YouTube Data API, batching concurrent lookups"""
+    global _api_batch_task
+    future = asyncio.get_running_loop().create_future()
+    _api_batch_waiters.setdefault(video_id, []).append(future)
+    if _api_batch_task is None or _api_batch_task.done():
+        _api_batch_task = asyncio.create_task(_flush_api_batch())
+    return await future
+
+def _cache_video_info(video_id: str, info: dict):
+    """Store video info in the in-memory LRU cache"""
+    video_info_cache[video_id] = (time.time() + VIDEO_INFO_CACHE_TTL, info)
+    video_info_cache.move_to_end(video_id)
+    if len(video_info_cache) > VIDEO_INFO_CACHE_MAX_SIZE:
+        video_info_cache.popitem(last=False)
+
+def _read_cache_file(cache_file: Path):
+    """Load cached video info from disk; returns None on miss or bad data"""
     try:
-        request = youtube.videos().list(
-            part="snippet,contentDetails,statistics",
-            id=video_id
-        )
-        response = request.execute()
-        
-        if not response['items']:
-            raise ValueError("Video not found")
-            
-        video = response['items'][0]
+        with open(cache_file, 'rb') as f:
+            return orjson.loads(f.read())
+    except Exception:
+        return None
+
+def _write_cache_file(cache_file: Path, info: dict):
+    """Persist video info to disk so it survives restarts"""
+    try:
+        with open(cache_file, 'wb') as f:
+            f.write(orjson.dumps({
+                'info': info,
+                'cache_time': time.time()
+            }))
+    except Exception:
+        pass
+
+def _get_video_info_from_ydl(url: str) -> dict:
+    """Get video info by running the yt-dlp extractor"""
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': True,
+        'skip_download': True,
+    }
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=False)
         return {
-            'title': video['snippet']['title'],
-            'duration': video['contentDetails']['duration'],
-            'thumbnail': video['snippet']['thumbnails']['high']['url'],
-            'uploader': video['snippet']['channelTitle'],
-            'view_count': int(video['statistics']['viewCount']),
-            'id': video_id
+            'title': info.get('title', 'Untitled'),
+            'duration': info.get('duration', 0),
+            'thumbnail': info.get('thumbnail', ''),
+            'uploader': info.get('uploader', 'Unknown'),
+            'view_count': info.get('view_count', 0),
+            'id': info.get('id', '')
         }
-    except HttpError as e:
-        logger.error(f"YouTube API error: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error fetching video info from YouTube API")
 
-async def get_video_info(url: str) -> dict:
-    """Get video info with fallback methods"""
+async def get_video_info(url: str, prefer: str = 'ydl') -> dict:
+    """Get video info with fallback methods
+
+    prefer='api' asks the Data API first, skipping YoutubeDL
+    construction entirely - the right order for metadata-only lookups.
+    """
     video_id = get_video_id(url)
     if not video_id:
         raise ValueError("Invalid YouTube URL")
-        
-    # Check cache first
+
+    # Check in-memory cache first - no disk touch, no JSON parse
+    cached = video_info_cache.get(video_id)
+    if cached:
+        if cached[0] > time.time():
+            video_info_cache.move_to_end(video_id)
+            return cached[1]
+        del video_info_cache[video_id]
+
+    # Fall back to the disk cache (warm start after restart); the read
+    # runs in a worker thread so it never blocks the event loop
     cache_file = CACHE_DIR / f"{video_id}.json"
-    if cache_file.exists():
+    cached_info = await asyncio.to_thread(_read_cache_file, cache_file)
+    if cached_info and time.time() - cached_info.get('cache_time', 0) < VIDEO_INFO_CACHE_TTL:
+        info = cached_info.get('info')
+        if info:
+            _cache_video_info(video_id, info)
+            return info
+
+    if prefer == 'api':
         try:
-            with open(cache_file, 'r') as f:
-                cached_info = json.load(f)
-                if time.time() - cached_info.get('cache_time', 0) < 3600:  # 1 hour cache
-                    return cached_info['info']
-        except Exception:
-            pass
-    
-    try:
-        # Try yt-dlp first
-        opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'skip_download': True,
-        }
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            result = {
-                'title': info.get('title', 'Untitled'),
-                'duration': info.get('duration', 0),
-                'thumbnail': info.get('thumbnail', ''),
-                'uploader': info.get('uploader', 'Unknown'),
-                'view_count': info.get('view_count', 0),
-                'id': info.get('id', '')
-            }
-    except Exception as e:
-        logger.warning(f"yt-dlp failed: {str(e)}, trying YouTube API")
-        # Fallback to YouTube API
-        result = await get_video_info_from_api(video_id)
-    
-    # Cache the result
-    try:
-        with open(cache_file, 'w') as f:
-            json.dump({
-                'info': result,
-                'cache_time': time.time()
-            }, f)
-    except Exception:
-        pass
+            result = await get_video_info_from_api(video_id)
+        except Exception as e:
+            logger.warning(f"YouTube API failed: {str(e)}, trying yt-dlp")
+            result = _get_video_info_from_ydl(url)
+    else:
+        try:
+            result = _get_video_info_from_ydl(url)
+        except Exception as e:
+            logger.warning(f"yt-dlp failed: {str(e)}, trying YouTube API")
+            # Fallback to YouTube API
+            result = await get_video_info_from_api(video_id)
     
+    # Cache the result; disk write happens off the event loop
+    _cache_video_info(video_id, result)
+    task = asyncio.create_task(asyncio.to_thread(_write_cache_file, cache_file, result))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
     return result
 
+_QUALITY_MAP = {
+    "high": "192",
+    "medium": "128",
+    "low": "96"
+}
+
+_BASE_HTTP_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+}
+
+# Static yt-dlp options, built once. Per-conversion keys (output path,
+# quality, user agent, extractor_args) are layered on in get_ydl_opts.
+_BASE_YDL_OPTS = {
+    'format': 'bestaudio/best',
+    'ffmpeg_location': FFMPEG_PATH,
+    'quiet': False,
+    'no_warnings': False,
+    'retries': 5,
+    'fragment_retries': 5,
+    'skip_unavailable_fragments': True,
+    'ignoreerrors': False,
+    'cookiefile': None,
+    'cookiesfrombrowser': None,
+    'referer': 'https://www.youtube.com/',
+    'throttledratelimit': 4194304,  # 4 MB/s
+    'noresizebuffer': True,
+    'socket_timeout': 10,
+    'source_address': '0.0.0.0',
+    'buffersize': 2048,
+    'retry_sleep': 2,
+    'retry_sleep_functions': {
+        'http': lambda x: 2,
+        'fragment': lambda x: 2,
+    },
+    'concurrent_fragment_downloads': 5,
+    'file_access_retries': 3,
+    'extractor_retries': 3,
+    'skip_download': False,
+    'keepvideo': False,
+    'writethumbnail': False,
+    'writesubtitles': False,
+    'writeautomaticsub': False,
+    'writedescription': False,
+    'writeinfojson': False,
+    'nocheckcertificate': True,
+    'prefer_insecure': True,
+    'geo_bypass': True,
+    'geo_verification_proxy': None,
+    'noprogress': False,
+    'progress_with_newline': True,
+    'updatetime': False,
+    'noplaylist': True,
+    'extract_flat': False,
+    'force_generic_extractor': False,
+    'allow_unplayable_formats': True,
+    'format_sort': ['res', 'ext:mp4:m4a', 'size', 'br', 'asr'],
+    'format_selection': 'bestaudio/best',
+    'postprocessor_hooks': [],
+    'merge_output_format': 'mp3',
+    'prefer_ffmpeg': True,
+    'keep_fragments': False,
+    'hls_prefer_native': True,
+    'hls_use_mpegts': True,
+    'external_downloader': None,
+    'external_downloader_args': None,
+}
+
 def get_ydl_opts(output_path: str, quality: str) -> dict:
-    quality_map = {
-        "high": "192",
-        "medium": "128",
-        "low": "96"
-    }
-    
+    bitrate = _QUALITY_MAP.get(quality, "192")
+    user_agent = get_random_user_agent()
+
     return {
-        'format': 'bestaudio/best',
+        **_BASE_YDL_OPTS,
         'outtmpl': output_path,
-        'ffmpeg_location': FFMPEG_PATH,
         'postprocessors': [{
             'key': 'FFmpegExtractAudio',
             'preferredcodec': 'mp3',
-            'preferredquality': quality_map.get(quality, "192"),
+            'preferredquality': bitrate,
         }],
-        'quiet': False,
-        'no_warnings': False,
-        'user_agent': get_random_user_agent(),
-        'retries': 10,
-        'fragment_retries': 10,
-        'skip_unavailable_fragments': True,
-        'ignoreerrors': False,
-        'cookiefile': None,
-        'cookiesfrombrowser': None,
-        'referer': 'https://www.youtube.com/',
-        'http_headers': {
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'none',
-            'User-Agent': get_random_user_agent(),
-        },
+        'postprocessor_args': [
+            '-ar', '44100',
+            '-ac', '2',
+            '-b:a', f'{bitrate}k'
+        ],
+        'user_agent': user_agent,
+        'http_headers': {**_BASE_HTTP_HEADERS, 'User-Agent': user_agent},
+        # Fresh nested dict: convert_video mutates player_client between retries
         'extractor_args': {
             'youtube': {
                 'player_client': ['android', 'web'],
@@ -262,64 +502,6 @@ def get_ydl_opts(output_path: str, quality: str) -> dict:
                 'formats': 'bestaudio/best'
             }
         },
-        'throttledratelimit': 4194304,  # 4 MB/s
-        'noresizebuffer': True,
-        'socket_timeout': 10,
-        'source_address': '0.0.0.0',
-        'buffersize': 2048,
-        'retry_sleep': 2,
-        'retry_sleep_functions': {
-            'http': lambda x: 2,
-            'fragment': lambda x: 2,
-        },
-        'concurrent_fragment_downloads': 5,
-        'file_access_retries': 3,
-        'extractor_retries': 3,
-        'fragment_retries': 5,
-        'retries': 5,
-        'skip_download': False,
-        'keepvideo': False,
-        'writethumbnail': False,
-        'writesubtitles': False,
-        'writeautomaticsub': False,
-        'postprocessor_args': [
-            '-ar', '44100',
-            '-ac', '2',
-            '-b:a', f'{quality_map.get(quality, "192")}k'
-        ],
-        'nocheckcertificate': True,
-        'prefer_insecure': True,
-        'geo_bypass': True,
-        'geo_verification_proxy': None,
-        'noprogress': False,
-        'progress_with_newline': True,
-        'updatetime': False,
-        'writedescription': False,
-        'writeinfojson': False,
-        'writethumbnail': False,
-        'writesubtitles': False,
-        'writeautomaticsub': False,
-        'skip_download': False,
-        'keepvideo': False,
-        'noplaylist': True,
-        'extract_flat': False,
-        'force_generic_extractor': False,
-        'allow_unplayable_formats': True,
-        'format_sort': ['res', 'ext:mp4:m4a', 'size', 'br', 'asr'],
-        'format_selection': 'bestaudio/best',
-        'postprocessor_hooks': [],
-        'merge_output_format': 'mp3',
-        'prefer_ffmpeg': True,
-        'keep_fragments': False,
-        'hls_prefer_native': True,
-        'hls_use_mpegts': True,
-        'external_downloader': None,
-        'external_downloader_args': None,
-        'postprocessor_args': [
-            '-ar', '44100',
-            '-ac', '2',
-            '-b:a', f'{quality_map.get(quality, "192")}k'
-        ],
     }
 
 async def convert_video(token: str, url: str, quality: str):
@@ -335,14 +517,14 @@ async def convert_video(token: str, url: str, quality: str):
         base_filename = f"{sanitized_title}-{info['id']}"
         output_path = str(DOWNLOAD_DIR / base_filename)
         
-        jobs[token] = {
+        _set_job(token, {
             'status': 'processing',
             'url': url,
             'filename': base_filename + ".mp3",
             'progress': 'Starting download...',
             'video_title': info['title'],
             'start_time': time.time()
-        }
+        })
         
         ydl_opts = get_ydl_opts(output_path, quality)
         
@@ -357,49 +539,79 @@ async def convert_video(token: str, url: str, quality: str):
         
         ydl_opts['progress_hooks'] = [progress_hook]
         
-        # Try multiple download attempts with different configurations
+        # Try multiple download attempts with different configurations,
+        # reusing one YoutubeDL instance so extractors are only set up once
         max_attempts = 3
-        for attempt in range(max_attempts):
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    await asyncio.get_event_loop().run_in_executor(None, lambda: ydl.download([url]))
-                break
-            except Exception as e:
-                if attempt == max_attempts - 1:
-                    raise
-                logger.warning(f"Download attempt {attempt + 1} failed: {str(e)}")
-                # Modify options for next attempt
-                ydl_opts['format'] = 'bestaudio/best' if attempt == 0 else 'bestaudio'
-                ydl_opts['extractor_args']['youtube']['player_client'] = ['android'] if attempt == 1 else ['web']
-                await asyncio.sleep(2)  # Wait before retry
-        
-        # Find and process the output file
-        actual_file = None
-        for ext in ['.mp3', '.m4a', '.webm', '.part']:
-            candidate = output_path + ext
-            if os.path.exists(candidate):
-                actual_file = candidate
-                break
-        
-        if not actual_file:
-            if os.path.exists(output_path):
-                actual_file = output_path
-            else:
-                raise FileNotFoundError("No output file found after conversion")
-        
-        if not actual_file.endswith('.mp3'):
-            mp3_file = actual_file.rsplit('.', 1)[0] + '.mp3'
-            os.rename(actual_file, mp3_file)
-            actual_file = mp3_file
+        ydl = yt_dlp.YoutubeDL(ydl_opts)
+        try:
+            for attempt in range(max_attempts):
+                try:
+                    await asyncio.get_running_loop().run_in_executor(conversion_pool, ydl.download, [url])
+                    break
+                except Exception as e:
+                    if attempt == max_attempts - 1:
+                        raise
+                    logger.warning(f"Download attempt {attempt + 1} failed: {str(e)}")
+                    # Modify options in place for next attempt. The format
+                    # selector is cached at __init__, so rebuild it too -
+                    # updating params['format'] alone is a no-op.
+                    new_format = 'bestaudio/best' if attempt == 0 else 'bestaudio'
+                    ydl.params['format'] = new_format
+                    ydl.format_selector = ydl.build_format_selector(new_format)
+                    ydl.params['extractor_args']['youtube']['player_client'] = ['android'] if attempt == 1 else ['web']
+                    await asyncio.sleep(2)  # Wait before retry
+        finally:
+            ydl.close()
         
-        file_size = os.path.getsize(actual_file)
+        # Fast path: the postprocessor wrote the .mp3 - one stat() gives
+        # both the existence check and the size
+        actual_file = output_path + '.mp3'
+        try:
+            file_size = os.stat(actual_file).st_size
+        except OSError:
+            # Fall back to one directory scan for intermediate files,
+            # ranked by the same priority the old per-extension probes had
+            # (so X.m4a beats X.m4a.part regardless of directory order)
+            actual_file = None
+            file_size = None
+            best_rank = len(_OUTPUT_EXT_PRIORITY)
+            prefix = base_filename + '.'
+            with os.scandir(DOWNLOAD_DIR) as it:
+                for entry in it:
+                    if not entry.name.startswith(prefix):
+                        continue
+                    for rank, ext in enumerate(_OUTPUT_EXT_PRIORITY):
+                        if entry.name.endswith(ext):
+                            break
+                    else:
+                        rank = len(_OUTPUT_EXT_PRIORITY)
+                    if rank < best_rank or actual_file is None:
+                        best_rank = rank
+                        actual_file = entry.path
+                        file_size = entry.stat().st_size
+                    if best_rank == 0:
+                        break
+
+            if not actual_file:
+                if os.path.exists(output_path):
+                    actual_file = output_path
+                    file_size = os.path.getsize(output_path)
+                else:
+                    raise FileNotFoundError("No output file found after conversion")
+
+            if not actual_file.endswith('.mp3'):
+                # os.replace also works on Windows when the target exists
+                mp3_file = actual_file.rsplit('.', 1)[0] + '.mp3'
+                os.replace(actual_file, mp3_file)
+                actual_file = mp3_file
+
         if file_size < 100 * 1024:
             os.remove(actual_file)
             raise ValueError(f"File too small ({file_size} bytes), likely incomplete")
         
         conversion_time = time.time() - jobs[token]['start_time']
         
-        jobs[token] = {
+        _set_job(token, {
             'status': 'completed',
             'url': url,
             'filename': os.path.basename(actual_file),
@@ -408,52 +620,68 @@ async def convert_video(token: str, url: str, quality: str):
             'video_title': info['title'],
             'file_size': file_size,
             'conversion_time': f"{conversion_time:.1f} seconds"
-        }
+        })
         logger.info(f"Conversion completed: {actual_file} ({file_size/1024:.1f} KB) in {conversion_time:.1f} seconds")
         
     except Exception as e:
         logger.error(f"Conversion failed: {str(e)}", exc_info=True)
-        jobs[token] = {
+        _set_job(token, {
             'status': 'failed',
             'url': url,
             'error': str(e),
             'video_title': info.get('title', 'Unknown') if 'info' in locals() else 'Unknown'
-        }
+        })
     finally:
         current_conversions.discard(url)
+        # Only clear our own mapping - a newer job may have re-registered the URL
+        if url_to_token.get(url) == token:
+            del url_to_token[url]
 
 async def cleanup_old_files():
-    """Delete files older than expiry time"""
+    """Delete files as their expiry comes due, driven by the expiry heap"""
     while True:
         try:
             current_time = time.time()
-            for token, job in list(jobs.items()):
-                if job.get('expires_at', 0) < current_time:
-                    file_path = job.get('file_path')
-                    if file_path and os.path.exists(file_path):
-                        os.remove(file_path)
-                        logger.info(f"Deleted expired file: {file_path}")
-                    if job['status'] != 'processing':
-                        del jobs[token]
+            while expiry_heap and expiry_heap[0][0] <= current_time:
+                _, token = heapq.heappop(expiry_heap)
+                job = jobs.get(token)
+                if job is None:
+                    continue
+                if job.get('expires_at', 0) > current_time:
+                    continue  # stale heap entry: expiry was extended since
+                file_path = job.get('file_path')
+                if file_path and os.path.exists(file_path):
+                    os.remove(file_path)
+                    logger.info(f"Deleted expired file: {file_path}")
+                if job['status'] != 'processing':
+                    del jobs[token]
         except Exception as e:
             logger.error(f"Cleanup error: {str(e)}")
-        await asyncio.sleep(60)
+        # Sleep until the next expiry, capped at the old 60s cadence
+        if expiry_heap:
+            delay = min(60.0, max(1.0, expiry_heap[0][0] - time.time()))
+        else:
+            delay = 60.0
+        await asyncio.sleep(delay)
 
 # Endpoints
 @app.post("/convert")
 async def start_conversion(request: ConversionRequest, background_tasks: BackgroundTasks):
-    # Check if URL is already being converted
-    if request.url in current_conversions:
-        existing_token = next((k for k, v in jobs.items() if v.get('url') == request.url and v.get('status') == 'processing'), None)
-        if existing_token:
+    url = str(request.url)
+    # Check if URL is already being converted - O(1) reverse lookup
+    existing_token = url_to_token.get(url)
+    if existing_token:
+        existing_job = jobs.get(existing_token)
+        if existing_job and existing_job.get('status') in ('queued', 'processing'):
             return {"token": existing_token, "message": "Conversion already in progress"}
-    
+
     token = str(uuid.uuid4())
-    jobs[token] = {'status': 'queued', 'url': str(request.url)}
+    _set_job(token, {'status': 'queued', 'url': url})
+    url_to_token[url] = token
     
     async def run_conversion():
         async with conversion_semaphore:
-            await convert_video(token, str(request.url), request.quality)
+            await convert_video(token, url, request.quality)
     
     background_tasks.add_task(run_conversion)
     return {"token": token, "message": "Conversion started"}
@@ -472,16 +700,24 @@ async def download_file(token: str):
         raise HTTPException(status_code=404, detail="File not ready or expired")
     
     file_path = job.get('file_path')
-    if not file_path or not os.path.exists(file_path):
+    try:
+        stat_result = os.stat(file_path) if file_path else None
+    except OSError:
+        stat_result = None
+    if not stat_result:
         raise HTTPException(status_code=404, detail="File not found")
-    
+
     # Update expiry time on download
     jobs[token]['expires_at'] = time.time() + (FILE_EXPIRY_MINUTES * 60)
-    
+    heapq.heappush(expiry_heap, (jobs[token]['expires_at'], token))
+
+    # Passing stat_result lets Starlette skip its own stat() and serve
+    # the file via sendfile with the size known up front
     return FileResponse(
         file_path,
         media_type='audio/mpeg',
         filename=job['filename'],
+        stat_result=stat_result,
         headers={
             'Content-Disposition': f'attachment; filename="{job["filename"]}"'
         }
@@ -490,7 +726,7 @@ async def download_file(token: str):
 @app.post("/video/metadata")
 async def get_metadata(request: VideoMetadataRequest):
     try:
-        return await get_video_info(str(request.url))
+        return await get_video_info(request.url, prefer='api')
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -500,4 +736,6 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    # uvloop (libuv) + httptools (C HTTP parser) instead of stdlib asyncio + h11.
+    # Single worker: jobs/cache state is in-process memory.
+    uvicorn.run(app, host="0.0.0.0", port=8001, loop="uvloop", http="httptools")
\ No newline at end of file